@@ -1,14 +1,20 @@
-# pip install streamlit pandas numpy plotly pydeck google-cloud-bigquery google-auth
+# pip install streamlit pandas numpy plotly pydeck google-cloud-bigquery google-cloud-bigquery-storage google-auth
 
 import streamlit as st
 import pandas as pd
 import numpy as np
 import streamlit.components.v1 as components
-import json
+import hashlib
+import time
+from pathlib import Path
 import plotly.express as px
 import pydeck as pdk
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud.bigquery_storage_v1 import writer as bqstorage_writer
+from google.api_core import exceptions as gcp_exceptions
 from google.oauth2 import service_account
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 from concurrent.futures import ThreadPoolExecutor
 
 # 카카오맵 API
@@ -33,6 +39,12 @@ enforce_min_width()
 PROJECT_ID = 'data-485606'
 DATASET_ID = 'postgresql'
 
+# 로컬 Parquet 캐시 (테이블 수정 시각 기준으로 자동 무효화)
+CACHE_DIR = Path('.bq_cache')
+CACHE_MAX_FILES = 30
+# 앱에서 직접 행을 추가하는 테이블은 디스크 캐시 제외 (Write API 추가 시 수정 시각이 갱신되지 않을 수 있음)
+DISK_CACHE_EXCLUDE = {f"{PROJECT_ID}.{DATASET_ID}.package"}
+
 # 1.1. 빅쿼리 연결
 @st.cache_resource
 def get_bq_client():
@@ -48,49 +60,179 @@ def get_bq_client():
         st.error(f"BigQuery 연결 실패: {e}")
         return None
 
-# 1.2. 데이터 로드
+# 1.2. 빅쿼리 Storage API 연결 (Arrow 스트리밍 조회용)
+@st.cache_resource
+def get_bqstorage_client():
+
+    try:
+        key_dict = dict(st.secrets['gcp_service_account'])
+
+        credentials = service_account.Credentials.from_service_account_info(key_dict)
+        return bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+    except Exception as e:
+        st.warning(f"BigQuery Storage API 연결 실패, 기본 API로 조회합니다: {e}")
+        return None
+
+# 1.3. 빅쿼리 Storage Write API 연결 (패키지 저장용)
+@st.cache_resource
+def get_bqwrite_client():
+
+    try:
+        key_dict = dict(st.secrets['gcp_service_account'])
+
+        credentials = service_account.Credentials.from_service_account_info(key_dict)
+        return bigquery_storage.BigQueryWriteClient(credentials=credentials)
+
+    except Exception as e:
+        st.warning(f"BigQuery Storage Write API 연결 실패, 로드 작업으로 저장합니다: {e}")
+        return None
+
+# 1.4. 로컬 캐시 조회
+def evict_table_cache():
+    files = sorted(CACHE_DIR.glob('*.parquet'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in files[CACHE_MAX_FILES:]:
+        path.unlink(missing_ok=True)
+
+def fetch_table_cached(client, bqstorage_client, table_id, month=None):
+    if table_id in DISK_CACHE_EXCLUDE:
+        return client.list_rows(table_id).to_dataframe(bqstorage_client=bqstorage_client)
+
+    table = client.get_table(table_id)
+    key = f"{table_id}@{table.modified.isoformat()}"
+    if month is not None:
+        key += f"#{month}"
+    path = CACHE_DIR / (hashlib.sha1(key.encode()).hexdigest() + '.parquet')
+
+    if path.exists():
+        path.touch()
+        return pd.read_parquet(path)
+
+    if month is None:
+        df = client.list_rows(table).to_dataframe(bqstorage_client=bqstorage_client)
+    else:
+        # 월 조건은 빅쿼리에서 필터링 (기간 목록과 동일하게 문자열로 비교)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter('month', 'STRING', month)]
+        )
+        query = f"SELECT * FROM `{table_id}` WHERE CAST(month AS STRING) = @month"
+        df = client.query(query, job_config=job_config).to_dataframe(bqstorage_client=bqstorage_client)
+
+    # 캐시 저장 실패는 조회 결과에 영향을 주지 않음
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        df.to_parquet(tmp_path, index=False)
+        tmp_path.replace(path)
+        evict_table_cache()
+    except Exception:
+        pass
+
+    return df
+
+def fetch_tables(client, bqstorage_client, tables, month=None):
+    data = {}
+
+    def fetch_table(key, table_id):
+        return key, fetch_table_cached(client, bqstorage_client, table_id, month)
+
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(fetch_table, k, tid) for k, tid in tables.items()]
+
+        for future in futures:
+            key, df = future.result()
+            data[key] = df
+
+    return data
+
+def normalize_keys(df):
+    if 'ftr_idn' in df.columns:
+        df['ftr_idn'] = df['ftr_idn'].astype(str)
+    if 'month' in df.columns:
+        df['month'] = df['month'].astype(str)
+
+# 저카디널리티 문자열 컬럼 (범주형으로 보관)
+CATEGORY_COLS = ['shelter_type', 'media_type', 'gender', 'month', 'package_type']
+
+def to_categories(df):
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+# 1.5. 데이터 로드 (전체 기간 공통 테이블)
 @st.cache_data(ttl=600)
 def load_data():
     client = get_bq_client()
     if client is None:
-        return None, None, None, None, None, None
+        return None, None, None, None
+    bqstorage_client = get_bqstorage_client()
 
     try:
         # 테이블 목록 정의 및 변수 할당
         tables = {
-            'digital': f"{PROJECT_ID}.{DATASET_ID}.digital",
             'factor': f"{PROJECT_ID}.{DATASET_ID}.factor_prediction_result",
-            'kpi': f"{PROJECT_ID}.{DATASET_ID}.kpi",
             'package': f"{PROJECT_ID}.{DATASET_ID}.package",
-            'shelter': f"{PROJECT_ID}.{DATASET_ID}.shelter",
-            'demographics': f"{PROJECT_ID}.{DATASET_ID}.demographics"
+            'shelter': f"{PROJECT_ID}.{DATASET_ID}.shelter"
         }
 
-        data = {}
+        # 기간 목록 쿼리는 먼저 제출해 테이블 다운로드와 동시에 실행
+        months_query = f"SELECT DISTINCT CAST(month AS STRING) AS month FROM `{PROJECT_ID}.{DATASET_ID}.kpi` ORDER BY month DESC"
+        months_job = client.query(months_query)
 
-        def fetch_table(key, table_id):
-            return key, client.list_rows(table_id).to_dataframe()
-            
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(fetch_table, k, tid) for k, tid in tables.items()]
-
-            for future in futures:
-                key, df = future.result()
-                data[key] = df
+        data = fetch_tables(client, bqstorage_client, tables)
 
-        digital = data['digital']
         factor = data['factor']
-        kpi = data['kpi']
         package = data['package']
         shelter = data['shelter']
+
+        available_months = months_job.to_dataframe()['month'].tolist()
+
+        # 전처리
+        for df in [package, shelter]:
+            normalize_keys(df)
+        to_categories(package)
+
+        # 병합 대상은 조인 키를 인덱스로 보관
+        shelter = shelter.set_index('ftr_idn')
+
+        # 매체 수량별 가중치 조회 테이블 (인덱스 = 수량, 없는 수량은 0)
+        factor = factor.dropna(subset=['quantity']).drop_duplicates('quantity')
+        if factor.empty:
+            factor_lut = None
+        else:
+            factor_lut = np.zeros(int(factor['quantity'].max()) + 1)
+            factor_lut[factor['quantity'].to_numpy(dtype=int)] = factor['correction_factor'].to_numpy(dtype=float)
+
+        return factor_lut, package, shelter, available_months
+
+    except Exception as e:
+        st.error(f"데이터 로드 중 오류 발생: {e}")
+        return None, None, None, None
+
+# 1.6. 데이터 로드 (월별 테이블)
+@st.cache_data(ttl=600)
+def load_month_data(month):
+    client = get_bq_client()
+    if client is None:
+        return None, None, None, None
+    bqstorage_client = get_bqstorage_client()
+
+    try:
+        tables = {
+            'digital': f"{PROJECT_ID}.{DATASET_ID}.digital",
+            'kpi': f"{PROJECT_ID}.{DATASET_ID}.kpi",
+            'demographics': f"{PROJECT_ID}.{DATASET_ID}.demographics"
+        }
+
+        data = fetch_tables(client, bqstorage_client, tables, month)
+
+        digital = data['digital']
+        kpi = data['kpi']
         demographics = data['demographics']
-            
+
         # 전처리
-        for df in [digital, kpi, package, shelter, demographics]:
-            if 'ftr_idn' in df.columns:
-                df['ftr_idn'] = df['ftr_idn'].astype(str)
-            if 'month' in df.columns:
-                df['month'] = df['month'].astype(str)
+        for df in [digital, kpi, demographics]:
+            normalize_keys(df)
 
         cols_to_numeric = ['stay_time', 'share_of_time']
         for col in cols_to_numeric:
@@ -108,13 +250,91 @@ def load_data():
             if col in kpi.columns:
                 kpi[col] = kpi[col].astype(str).str.strip()
 
-        return digital, factor, kpi, package, shelter, demographics
+        # 매체명 검색용 소문자 컬럼
+        kpi['_shelter_name_lc'] = kpi['shelter_name'].str.lower()
+
+        # 저카디널리티 문자열은 범주형, ROTS/Reach는 정수값일 때만 축소 (합계 정밀도 유지)
+        for df in [digital, kpi, demographics]:
+            to_categories(df)
+
+        for df in [kpi, demographics]:
+            for col in ['rots', 'reach']:
+                if col in df.columns:
+                    df[col] = pd.to_numeric(df[col], downcast='integer')
+
+        # ftr_idn 정렬 인덱스로 보관 (인덱스명은 비워 컬럼과 충돌 방지)
+        kpi = kpi.set_index('ftr_idn', drop=False).rename_axis(None).sort_index()
+        demographics = demographics.set_index('ftr_idn', drop=False).rename_axis(None).sort_index()
+        # 병합 대상은 조인 키를 인덱스로 보관 (월 조건은 조회 시 적용됨)
+        digital = digital.drop(columns=['month']).set_index('ftr_idn')
+
+        # 조회 시각: 파생 캐시(build_merged)의 데이터 버전 키로 사용
+        return digital, kpi, demographics, time.time()
 
     except Exception as e:
         st.error(f"데이터 로드 중 오류 발생: {e}")
-        return None, None, None, None, None, None
+        return None, None, None, None
+
+factor_lut, package, shelter_info, available_months = load_data()
+digital, kpi, demographics, month_loaded_at = None, None, None, None
+selected_month = None
+
+# 1.7. 패키지 저장
+PROTO_FIELD_TYPES = {
+    'STRING': (descriptor_pb2.FieldDescriptorProto.TYPE_STRING, str),
+    'INTEGER': (descriptor_pb2.FieldDescriptorProto.TYPE_INT64, int),
+    'INT64': (descriptor_pb2.FieldDescriptorProto.TYPE_INT64, int),
+    'FLOAT': (descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE, float),
+    'FLOAT64': (descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE, float),
+}
+
+def build_row_message_class(fields):
+    # 테이블 스키마로 행 단위 protobuf 메시지 정의
+    descriptor = descriptor_pb2.DescriptorProto(name='PackageRow')
+    for number, field in enumerate(fields, start=1):
+        descriptor.field.add(
+            name=field.name,
+            number=number,
+            type=PROTO_FIELD_TYPES[field.field_type][0],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+        )
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(descriptor_pb2.FileDescriptorProto(name='package_row.proto', message_type=[descriptor]))
+    return descriptor, message_factory.GetMessageClass(pool.FindMessageTypeByName('PackageRow'))
+
+def append_rows_to_bq(client, write_client, table_id, df):
+    table = client.get_table(table_id)
+    fields = [f for f in table.schema if f.name in df.columns]
+    descriptor, row_class = build_row_message_class(fields)
+
+    # COMMITTED 스트림: 추가 즉시 조회 가능
+    write_stream = write_client.create_write_stream(
+        parent=write_client.table_path(table.project, table.dataset_id, table.table_id),
+        write_stream=bigquery_storage.WriteStream(type_=bigquery_storage.WriteStream.Type.COMMITTED)
+    )
 
-digital, factor_df, kpi, package, shelter_info, demographics = load_data()
+    # 전체 행을 하나의 배치로 전송
+    proto_rows = bigquery_storage.ProtoRows()
+    for record in df.to_dict('records'):
+        row = row_class(**{f.name: PROTO_FIELD_TYPES[f.field_type][1](record[f.name]) for f in fields})
+        proto_rows.serialized_rows.append(row.SerializeToString())
+
+    request_template = bigquery_storage.AppendRowsRequest(
+        write_stream=write_stream.name,
+        proto_rows=bigquery_storage.AppendRowsRequest.ProtoData(
+            writer_schema=bigquery_storage.ProtoSchema(proto_descriptor=descriptor)
+        )
+    )
+    append_stream = bqstorage_writer.AppendRowsStream(write_client, request_template)
+    try:
+        request = bigquery_storage.AppendRowsRequest(
+            offset=0,
+            proto_rows=bigquery_storage.AppendRowsRequest.ProtoData(rows=proto_rows)
+        )
+        append_stream.send(request).result()
+    finally:
+        append_stream.close()
 
 def save_package_to_bq(pkg_name, pkg_type, id_list):
     client = get_bq_client()
@@ -130,6 +350,15 @@ def save_package_to_bq(pkg_name, pkg_type, id_list):
 
         table_id = f"{PROJECT_ID}.{DATASET_ID}.package"
 
+        write_client = get_bqwrite_client()
+        if write_client is not None:
+            try:
+                append_rows_to_bq(client, write_client, table_id, new_data)
+                return True
+            except (gcp_exceptions.PermissionDenied, gcp_exceptions.Forbidden):
+                # Write API 권한이 없는 경우 로드 작업으로 저장
+                pass
+
         job_config = bigquery.LoadJobConfig(write_disposition='WRITE_APPEND')
         job = client.load_table_from_dataframe(new_data, table_id, job_config=job_config)
         job.result()
@@ -142,18 +371,100 @@ def save_package_to_bq(pkg_name, pkg_type, id_list):
 # -----------------------------------------------------------
 # 2. 유틸리티 함수
 # -----------------------------------------------------------
-def get_color_by_type(shelter_type):
-    colors = {
-        '가로변 쉘터': '#153b5d',       
-        '중앙차로버스 쉘터': '#00b8bc', 
-        '환승센터': '#ffc000',          
-        '관광안내판': '#fc766a',        
-        '마을버스 쉘터': '#3247a6',     
-    }
-    return colors.get(shelter_type, '#808080')
-
-def render_kakao_map(lat, lon, zoom_level, data):
-    map_data_json = json.dumps(data)
+COLOR_DICT = {
+    '가로변 쉘터': '#153b5d',       
+    '중앙차로버스 쉘터': '#00b8bc', 
+    '환승센터': '#ffc000',          
+    '관광안내판': '#fc766a',        
+    '마을버스 쉘터': '#3247a6',     
+}
+DEFAULT_COLOR = '#808080'
+
+# ROTS, Reach 표 표시 형식 (정수 반올림 후 천 단위 구분)
+METRIC_COLUMN_CONFIG = {
+    'ROTS': st.column_config.NumberColumn('ROTS', format='localized'),
+    'Reach': st.column_config.NumberColumn('Reach', format='localized'),
+}
+
+REGION_PKG_WEIGHTS = {'강남D': 0.5430, '서초D': 0.7165, '이태원D': 0.3311, '종로D': 0.4892, '종로중구MD': 0.5442}
+
+def get_correction(count, factor_lut, pkg_option=None):
+    if count <= 0:
+        return 0
+    if pkg_option in REGION_PKG_WEIGHTS:
+        return REGION_PKG_WEIGHTS[pkg_option]
+    if factor_lut is None:
+        return 0
+    # 최대 수량을 넘는 경우 최대 수량의 가중치 적용
+    return factor_lut[min(count, len(factor_lut) - 1)]
+
+@st.cache_data(ttl=600)
+def pkg_option_sets(_context_df, month, loaded_at, pkg_name):
+    # 월/조회 시각/패키지 조합별 설치 유형, 매체 유형 선택지
+    return sorted(_context_df['shelter_type'].unique()), sorted(_context_df['media_type'].unique())
+
+def calculate_metrics(merged, calc_mode):
+    k_rots = merged['rots'].to_numpy(dtype=float)
+    k_reach = merged['reach'].to_numpy(dtype=float)
+    if calc_mode == '디지털 공식 미적용':
+        return k_rots, k_reach
+
+    stay = merged['stay_time'].to_numpy(dtype=float)
+    sot = merged['share_of_time'].to_numpy(dtype=float)
+    s_type = merged['shelter_type']
+    m_type = merged['media_type']
+    pkg_type = merged['package_type'] if 'package_type' in merged.columns else pd.Series('P', index=merged.index)
+
+    # Case A: 관광안내판 & 포스터
+    is_tour_poster = ((s_type == '관광안내판') & (m_type == '포스터')).to_numpy()
+    # Case B: 디지털 공식 적용 (체류 시간이 있는 경우만)
+    apply_digital = ((pkg_type == 'D') | (m_type == '디지털')).to_numpy() & ~np.isnan(stay)
+
+    sot_eff = 0.05 if calc_mode == '디지털 풀 구좌' else sot
+    time_factor = (np.maximum(stay - 1, 0) + 30) / 30.0
+
+    # 행별 보정 계수를 한 번만 산출해 ROTS, Reach에 공통 적용 (Case C: 일반은 1.0)
+    scale = np.select([is_tour_poster, apply_digital], [0.5, time_factor * sot_eff * 0.5], default=1.0)
+    return k_rots * scale, k_reach * scale
+
+@st.cache_data(ttl=600, max_entries=32)
+def build_merged(_kpi, _digital, _demographics, _shelter_info, _pkg_mapping,
+                 month, loaded_at, idns, gender, age_code, calc_mode, filter_mode, pkg_key):
+    # 프레임 인자는 해시하지 않음: 월/조회 시각/매체/필터/패키지 조합이 캐시 키
+    target_kpi = _kpi.loc[_kpi.index.intersection(idns)]
+    is_demo_filtered = (gender != '전체') or (age_code != 0)
+
+    if is_demo_filtered and _demographics is not None:
+        # 조건에 부합하는 성연령 데이터 필터링
+        demo_subset = _demographics.loc[_demographics.index.intersection(idns)]
+
+        if gender != '전체':
+            demo_subset = demo_subset[demo_subset['gender'] == gender]
+        if age_code != 0:
+            demo_subset = demo_subset[demo_subset['age'] == age_code]
+
+        # ID별 그룹화하여 ROTS, Reach 산출
+        grouped_demo = demo_subset.groupby('ftr_idn', sort=False)[['rots', 'reach']].sum()
+        # 기존 KPI 총합을 필터링된 합계로 대체 (성연령 데이터가 없는 매체는 0)
+        target_kpi[['rots', 'reach']] = grouped_demo.reindex(target_kpi['ftr_idn'].to_numpy(), fill_value=0).to_numpy(dtype=float)
+
+    # 병합 대상 테이블에 ftr_idn 중복이 있으면 테이블명을 담아 MergeError 발생
+    join_table = 'package'
+    try:
+        target_kpi = target_kpi.join(_pkg_mapping.rename('package_type'), on='ftr_idn', how='left', validate='many_to_one')
+        join_table = 'digital'
+        merged = target_kpi.join(_digital, on='ftr_idn', how='left', rsuffix='_digital', validate='many_to_one')
+        join_table = 'shelter'
+        merged = merged.join(_shelter_info[['longitude', 'latitude', 'grade']], on='ftr_idn', how='left', validate='many_to_one')
+    except pd.errors.MergeError as e:
+        raise pd.errors.MergeError(f"{join_table} 테이블에 중복된 ftr_idn이 있습니다.") from e
+
+    # ROTS 및 Reach 계산
+    merged['adj_rots'], merged['adj_reach'] = calculate_metrics(merged, calc_mode)
+    return merged
+
+def render_kakao_map(lat, lon, zoom_level, map_data_json):
+    # 지도 HTML은 데이터와 무관하게 고정: 재실행 시 iframe과 SDK를 그대로 유지
     html_code = f"""
     <!DOCTYPE html>
     <html>
@@ -167,9 +478,8 @@ def render_kakao_map(lat, lon, zoom_level, data):
         <script type='text/javascript' src='https://dapi.kakao.com/v2/maps/sdk.js?appkey={KAKAO_API_KEY}'></script>
         <script>
             var container = document.getElementById('map');
-            var options = {{ center: new kakao.maps.LatLng({lat}, {lon}), level: {zoom_level} }};
+            var options = {{ center: new kakao.maps.LatLng(37.5665, 126.9780), level: 9 }};
             var map = new kakao.maps.Map(container, options);
-            var positions = {map_data_json};
             var circles = [];
 
             function getRadiusByLevel(level) {{
@@ -181,21 +491,14 @@ def render_kakao_map(lat, lon, zoom_level, data):
                     return 300;
                 }}
             }}
-            
-            positions.forEach(function(pos) {{
-                var initRadius = getRadiusByLevel(map.getLevel());
+
+            function createCircle() {{
                 var circle = new kakao.maps.Circle({{
-                    center : new kakao.maps.LatLng(pos.lat, pos.lng),
-                    radius: initRadius, strokeWeight: 2, strokeColor: '#ffffff', strokeOpacity: 0.9,
-                    strokeStyle: 'solid', fillColor: pos.color, fillOpacity: 0.8 
-                }}); 
-                circle.setMap(map);
-                circles.push(circle);
-                
-                var iwContent = '<div style="padding:5px; font-size:12px; color:#000;">' + \
-                                '<b>' + pos.name + '</b><br>' + 'ROTS: ' + pos.rots + '<br>' + 'Reach: ' + pos.reach + '</div>';
-                var infowindow = new kakao.maps.InfoWindow({{ content : iwContent }});
-                
+                    strokeWeight: 2, strokeColor: '#ffffff', strokeOpacity: 0.9,
+                    strokeStyle: 'solid', fillOpacity: 0.8
+                }});
+                var infowindow = new kakao.maps.InfoWindow({{ content : '' }});
+
                 kakao.maps.event.addListener(circle, 'mouseover', function() {{
                     infowindow.setPosition(circle.getPosition());
                     infowindow.open(map);
@@ -203,25 +506,78 @@ def render_kakao_map(lat, lon, zoom_level, data):
                 kakao.maps.event.addListener(circle, 'mouseout', function() {{
                     infowindow.close();
                 }});
-            }});
+                return {{ circle: circle, infowindow: infowindow }};
+            }}
+
+            // 기존 원은 재사용하고 위치, 색상, 정보창만 갱신
+            function redrawCircles(payload) {{
+                map.setLevel(payload.level);
+                map.setCenter(new kakao.maps.LatLng(payload.lat, payload.lng));
+                var radius = getRadiusByLevel(map.getLevel());
+
+                payload.positions.forEach(function(pos, i) {{
+                    if (i >= circles.length) {{
+                        circles.push(createCircle());
+                    }}
+                    var item = circles[i];
+                    item.circle.setPosition(new kakao.maps.LatLng(pos.lat, pos.lng));
+                    item.circle.setOptions({{ radius: radius, fillColor: pos.color }});
+                    item.circle.setMap(map);
+                    item.infowindow.setContent(
+                        '<div style="padding:5px; font-size:12px; color:#000;">' +
+                        '<b>' + pos.name + '</b><br>' + 'ROTS: ' + pos.rots + '<br>' + 'Reach: ' + pos.reach + '</div>'
+                    );
+                }});
+
+                circles.splice(payload.positions.length).forEach(function(item) {{
+                    item.infowindow.close();
+                    item.circle.setMap(null);
+                }});
+            }}
 
             kakao.maps.event.addListener(map, 'zoom_changed', function() {{
                 var level = map.getLevel();
                 var newRadius = getRadiusByLevel(level);
 
                 for (var i = 0; i < circles.length; i++) {{
-                    circles[i].setOptions({{radius: newRadius}});
+                    circles[i].circle.setOptions({{radius: newRadius}});
                 }}
             }});
             
             var zoomControl = new kakao.maps.ZoomControl();
             map.addControl(zoomControl, kakao.maps.ControlPosition.RIGHT);
+
+            // 지도보다 먼저 전달된 데이터 반영 후 이후 갱신 수신
+            if (window.parent.oohMapPayload) {{
+                redrawCircles(window.parent.oohMapPayload);
+            }}
+            window.addEventListener('message', function(e) {{
+                // 같은 출처(갱신용 srcdoc iframe)의 메시지만 수신
+                if (e.origin !== window.origin) return;
+                if (e.data && e.data.type === 'ooh-map-update') {{
+                    redrawCircles(e.data.payload);
+                }}
+            }});
         </script>
     </body>
     </html>
     """
     components.html(html_code, height=600)
 
+    # 데이터가 바뀐 경우에만 갱신 스크립트가 다시 실행되어 지도 iframe에 전달
+    update_code = f"""
+    <script>
+        var payload = {{ lat: {lat}, lng: {lon}, level: {zoom_level}, positions: {map_data_json} }};
+        window.parent.oohMapPayload = payload;
+        Array.prototype.forEach.call(window.parent.document.getElementsByTagName('iframe'), function(frame) {{
+            if (frame.contentWindow !== window) {{
+                frame.contentWindow.postMessage({{ type: 'ooh-map-update', payload: payload }}, window.origin);
+            }}
+        }});
+    </script>
+    """
+    components.html(update_code, height=0)
+
 # -----------------------------------------------------------
 # 3. 사이드바 UI
 # -----------------------------------------------------------
@@ -254,10 +610,10 @@ with st.sidebar:
         # 3.1.1. 상위 필터
         with st.expander('기본 필터링', expanded=True):
             
-            if kpi is not None:
-                available_months = sorted(kpi['month'].unique(), reverse=True)
+            if available_months is not None:
                 if len(available_months) > 0:
                     selected_month = st.selectbox('기간', available_months)
+                    digital, kpi, demographics, month_loaded_at = load_month_data(selected_month)
                 else:
                     st.warning('데이터 부족')
                     selected_month = None
@@ -274,33 +630,27 @@ with st.sidebar:
                 if '전체 (' in selected_package_option:
                     is_view_all = True
                     if kpi is not None:
-                        pkg_shelters = kpi[kpi['month'] == selected_month]['ftr_idn'].unique()
-                        
-                        pkg_mapping = pd.DataFrame({'ftr_idn': pkg_shelters})
+                        pkg_shelters = kpi['ftr_idn'].unique()
                         
-                        if '디지털' in selected_package_option:
-                            pkg_mapping['package_type'] = 'D'
-                        else:
-                            pkg_mapping['package_type'] = 'P'
+                        # ftr_idn 인덱스의 패키지 유형 매핑
+                        view_all_type = 'D' if '디지털' in selected_package_option else 'P'
+                        pkg_mapping = pd.Series(view_all_type, index=pkg_shelters, name='package_type')
                 else:
                     is_view_all = False
-                    pkg_filtered = package[package['package_name'] == selected_package_option].copy()
-                    pkg_mapping = pkg_filtered[['ftr_idn', 'package_type']].drop_duplicates('ftr_idn')
-                    pkg_shelters = pkg_mapping['ftr_idn'].unique()
+                    pkg_filtered = package[package['package_name'] == selected_package_option]
+                    pkg_mapping = pkg_filtered.groupby('ftr_idn', sort=False)['package_type'].first()
+                    pkg_shelters = pkg_mapping.index.to_numpy()
                 
-                if len(pkg_shelters) > 0:
-                    current_context_df = kpi[
-                        (kpi['month'] == selected_month) & 
-                        (kpi['ftr_idn'].isin(pkg_shelters))
-                    ]
+                if len(pkg_shelters) > 0 and kpi is not None:
+                    current_context_df = kpi.loc[kpi.index.intersection(pkg_shelters)]
                     
+                    avail_shelter_types, avail_media_types = pkg_option_sets(current_context_df, selected_month, month_loaded_at, selected_package_option)
+
                     # --- 설치 유형 ---
-                    avail_shelter_types = sorted(current_context_df['shelter_type'].unique())
                     shelter_options = ['전체'] + avail_shelter_types
                     selected_shelter_type = st.selectbox('설치 유형', shelter_options)
                     
                     # --- 매체 유형 ---
-                    avail_media_types = sorted(current_context_df['media_type'].unique())
                     media_options = ['전체'] + avail_media_types
                     selected_media_type = st.selectbox('매체 유형', media_options)
 
@@ -320,11 +670,8 @@ with st.sidebar:
         search_keyword = st.text_input('검색', placeholder='매체명을 입력하세요.')
         
         if search_keyword and len(pkg_shelters) > 0 and kpi is not None:
-            search_result = kpi[
-                (kpi['month'] == selected_month) &
-                (kpi['ftr_idn'].isin(pkg_shelters)) &
-                (kpi['shelter_name'].str.contains(search_keyword, case=False, na=False))
-            ]
+            search_base = kpi.loc[kpi.index.intersection(pkg_shelters)]
+            search_result = search_base[search_base['_shelter_name_lc'].str.contains(search_keyword.lower(), regex=False, na=False)]
             # 검색 결과로 ID 리스트 갱신
             pkg_shelters = search_result['ftr_idn'].unique()
     
@@ -339,9 +686,9 @@ with st.sidebar:
             real_pkg_type = 'D' if input_pkg_type == '디지털' else 'P'
             
             # 3.2.2. 기간 선택
-            if kpi is not None:
-                available_months = sorted(kpi['month'].unique(), reverse=True)
+            if available_months:
                 selected_month = st.selectbox('분석 기간 설정', available_months, key='custom_month_select')
+                digital, kpi, demographics, month_loaded_at = load_month_data(selected_month)
             else:
                 selected_month = None
                 
@@ -355,15 +702,13 @@ with st.sidebar:
             # 3.2.4. 유효성 검사 및 데이터 매핑
             if input_text and selected_month and kpi is not None:
                 raw_ids = [x.strip() for x in input_text.replace('\n', ',').split(',') if x.strip()]
-                valid_shelters = kpi[(kpi['month'] == selected_month) & (kpi['ftr_idn'].isin(raw_ids))]
+                valid_shelters = kpi.loc[kpi.index.intersection(raw_ids)]
                 found_ids = valid_shelters['ftr_idn'].unique()
 
                 if len(found_ids) > 0:
                     st.success(f"총 {len(raw_ids)}개 중 {len(found_ids)}개 매체 확인")
 
-                    temp_mapping = pd.DataFrame({'ftr_idn': found_ids})
-                    temp_mapping['package_type'] = real_pkg_type
-                    pkg_mapping = temp_mapping
+                    pkg_mapping = pd.Series(real_pkg_type, index=found_ids, name='package_type')
 
                     final_selected_idns = found_ids
 
@@ -415,102 +760,29 @@ with st.sidebar:
 # -----------------------------------------------------------
 if kpi is not None and len(final_selected_idns) > 0:
     
-    # 4.1. 데이터 병합
-    target_kpi = kpi[(kpi['month'] == selected_month) & (kpi['ftr_idn'].isin(final_selected_idns))].copy()
-    is_demo_filtered = (selected_gender != '전체') or (selected_age_code != 0)
-
-    if is_demo_filtered and demographics is not None:
-        # 조건에 부합하는 성연령 데이터 필터링
-        demo_subset_mask = (demographics['month'] == selected_month) & (demographics['ftr_idn'].isin(final_selected_idns))
-
-        if selected_gender != '전체':
-            demo_subset_mask &= (demographics['gender'] == selected_gender)
-        if selected_age_code != 0:
-            demo_subset_mask &= (demographics['age'] == selected_age_code)
-
-        demo_subset = demographics[demo_subset_mask].copy()
-        # ID별 그룹화하여 ROTS, Reach 산출
-        grouped_demo = demo_subset.groupby('ftr_idn')[['rots', 'reach']].sum().reset_index()
-        # 기존 KPI 테이블에서 총합 제거 후 필터링된 합계로 병합
-        target_kpi = target_kpi.drop(columns=['rots', 'reach'])
-        target_kpi = pd.merge(target_kpi, grouped_demo, on='ftr_idn', how='left', suffixes=('', '_digital'))
-        target_kpi[['rots', 'reach']] = target_kpi[['rots', 'reach']].fillna(0)
-    
-    target_kpi = pd.merge(target_kpi, pkg_mapping, on='ftr_idn', how='left')
-    merged = pd.merge(target_kpi, digital, on=['month', 'ftr_idn'], how='left', suffixes=('', '_digital'))
-    merged = pd.merge(merged, shelter_info[['ftr_idn', 'longitude', 'latitude', 'grade']], on='ftr_idn', how='left')
-
-    # 4.2. ROTS 및 Reach 계산
-    def calculate_metrics_row(row):
-        k_rots = row['rots']
-        k_reach = row['reach']
-        if calc_mode == '디지털 공식 미적용':
-            return pd.Series([k_rots, k_reach], index=['adj_rots', 'adj_reach'])
-                
-        pkg_type = row.get('package_type', 'P')
-        s_type = row['shelter_type']
-        m_type = row['media_type']
-        
-        # Case A: 관광안내판 & 포스터
-        if (s_type == '관광안내판') and (m_type == '포스터'):
-            return pd.Series([k_rots / 2.0, k_reach / 2.0], index=['adj_rots', 'adj_reach'])
-
-        # Case B: 디지털 공식 적용 판단
-        apply_digital_formula = (pkg_type == 'D') or (m_type == '디지털')
-        
-        if apply_digital_formula:
-            if pd.notnull(row['stay_time']):
-                stay_time = float(row['stay_time'])
-                
-                if calc_mode == '디지털 풀 구좌':
-                    share_of_time = 0.05
-                else:
-                    share_of_time = float(row['share_of_time'])
-                time_factor = (max(stay_time - 1, 0) + 30) / 30.0
-                adj_rots = time_factor * k_rots * share_of_time * 0.5
-                adj_reach = time_factor * k_reach * share_of_time * 0.5
-                
-                return pd.Series([adj_rots, adj_reach], index=['adj_rots', 'adj_reach'])
-            else:
-                return pd.Series([k_rots, k_reach], index=['adj_rots', 'adj_reach'])
-        
-        # Case C: 일반
-        return pd.Series([k_rots, k_reach], index=['adj_rots', 'adj_reach'])
-
-    metrics_df = merged.apply(calculate_metrics_row, axis=1)
-    merged['adj_rots'] = metrics_df['adj_rots']
-    merged['adj_reach'] = metrics_df['adj_reach']
+    # 4.1. 데이터 병합 및 ROTS, Reach 계산 (필터 조합별 캐시)
+    pkg_key = selected_package_option if filter_mode == '패키지' else real_pkg_type
+    try:
+        merged = build_merged(
+            kpi, digital, demographics, shelter_info, pkg_mapping,
+            selected_month, month_loaded_at, tuple(sorted(final_selected_idns)), selected_gender, selected_age_code,
+            calc_mode, filter_mode, pkg_key
+        )
+    except pd.errors.MergeError as e:
+        st.error(f"데이터 병합 중 오류 발생: {e}")
+        st.stop()
     
-    # 4.3. 총합 및 가중치 적용
+    # 4.2. 총합 및 가중치 적용
     total_shelters = len(merged)
     sum_adj_rots = merged['adj_rots'].sum()
     sum_adj_reach = merged['adj_reach'].sum()
 
-    region_pkg_weights = {'강남D': 0.5430, '서초D': 0.7165, '이태원D': 0.3311, '종로D': 0.4892, '종로중구MD': 0.5442}
-    
-    correction_val = 0
-
-    if total_shelters > 0:
-        if filter_mode == '패키지' and selected_package_option in region_pkg_weights:
-            correction_val = region_pkg_weights[selected_package_option]
-        else:
-            if factor_df is not None:
-                max_qty = factor_df['quantity'].max()
-                lookup_qty = min(total_shelters, max_qty)
-
-                found_val = factor_df.loc[factor_df['quantity'] == lookup_qty, 'correction_factor']
-                if not found_val.empty:
-                    correction_val = found_val.values[0]
-                else:
-                    correction_val = 0
-            else:
-                correction_val = 0
-    else:
-        correction_val = 0
+    region_pkg_option = selected_package_option if filter_mode == '패키지' else None
+    correction_val = get_correction(total_shelters, factor_lut, region_pkg_option)
 
     final_total_reach = sum_adj_reach * correction_val
     
-    # 4.4. 결과 시각화
+    # 4.3. 결과 시각화
     if filter_mode == '패키지':
         title_prefix = '전체' if is_view_all else f"패키지 [{selected_package_option}]"
     else: 
@@ -523,7 +795,7 @@ if kpi is not None and len(final_selected_idns) > 0:
     
     tab1, tab2 = st.tabs(['메인 대시보드', '성연령별 분석'])
 
-    # 4.4.1. Tab 1: 메인 대시보드
+    # 4.3.1. Tab 1: 메인 대시보드
     with tab1:
         c1, c2 = st.columns([2, 1])
 
@@ -551,27 +823,15 @@ if kpi is not None and len(final_selected_idns) > 0:
             cur_count = len(final_df)
             cur_rots = final_df['adj_rots'].sum()
             cur_reach = final_df['adj_reach'].sum()
-            region_pkg_weights_map = {'강남D': 0.5430, '서초D': 0.7165, '이태원D': 0.3311, '종로D': 0.4892, '종로중구MD': 0.5442}
-            cur_correction = 0
-
-            if cur_count > 0:
-                if filter_mode == '패키지' and selected_package_option in region_pkg_weights_map:
-                    cur_correction = region_pkg_weights_map[selected_package_option]
-                else:
-                    if factor_df is not None:
-                        max_qty = factor_df['quantity'].max()
-                        lookup_qty = min(cur_count, max_qty) # 잘린 개수 기준
-                        found_val = factor_df.loc[factor_df['quantity'] == lookup_qty, 'correction_factor']
-                        cur_correction = found_val.values[0] if not found_val.empty else 0
-                    else:
-                        cur_correction = 0
+            cur_correction = get_correction(cur_count, factor_lut, region_pkg_option) # 잘린 개수 기준
             
             final_cur_reach = cur_reach * cur_correction
 
             d_df = final_df[['shelter_name', 'shelter_type', 'media_type', 'adj_rots', 'adj_reach']].copy()
             d_df.columns = ['매체명', '설치 유형', '매체 유형', 'ROTS', 'Reach']
             d_df.index += 1
-            st.dataframe(d_df.style.format({'ROTS': '{:,.0f}', 'Reach': '{:,.0f}'}), height=600, use_container_width=True)
+            d_df[['ROTS', 'Reach']] = d_df[['ROTS', 'Reach']].round()
+            st.dataframe(d_df, column_config=METRIC_COLUMN_CONFIG, height=600, use_container_width=True)
 
             with metrics_placeholder.container():
                 col1, col2, col3, col4, col5 = st.columns(5)
@@ -591,24 +851,23 @@ if kpi is not None and len(final_selected_idns) > 0:
                 map_type = st.radio('지도 타입 선택', ['Kakao', 'Dark'], horizontal=True,label_visibility='collapsed')
 
             map_df = final_df[['latitude', 'longitude', 'shelter_name', 'adj_rots', 'adj_reach', 'shelter_type']].dropna(subset=['latitude', 'longitude'])
-            map_df['color'] = map_df['shelter_type'].apply(get_color_by_type)
+            # 범주형 컬럼은 카테고리 단위로 매핑되므로 object로 변환 후 기본색 채움
+            map_df['color'] = map_df['shelter_type'].map(COLOR_DICT).astype(object).fillna(DEFAULT_COLOR)
             
             if map_type == 'Kakao':
-                k_data = [{
-                    'lat': r['latitude'], 
-                    'lng': r['longitude'], 
-                    'name': r['shelter_name'], 
-                    'color': r['color'],
-                    'rots': f"{r['adj_rots']:,.0f}",
-                    'reach': f"{r['adj_reach']:,.0f}"
-                } for _, r in map_df.iterrows()]
+                k_data_json = map_df.assign(
+                    rots=map_df['adj_rots'].map('{:,.0f}'.format),
+                    reach=map_df['adj_reach'].map('{:,.0f}'.format)
+                ).rename(columns={'latitude': 'lat', 'longitude': 'lng', 'shelter_name': 'name'})[
+                    ['lat', 'lng', 'name', 'color', 'rots', 'reach']
+                ].to_json(orient='records')
 
                 clat = map_df['latitude'].mean() if not map_df.empty else 37.5665
                 clon = map_df['longitude'].mean() if not map_df.empty else 126.9780
                 czoom = 7 if not map_df.empty else 9
                 
                 if not KAKAO_API_KEY: st.warning('API 키 없음')
-                else: render_kakao_map(clat, clon, czoom, k_data)
+                else: render_kakao_map(clat, clon, czoom, k_data_json)
             else:
                 st.map(map_df, latitude='latitude', longitude='longitude', color='color', zoom=11, use_container_width=True, height=600)
             legend_html = """
@@ -632,33 +891,33 @@ if kpi is not None and len(final_selected_idns) > 0:
             """
             st.markdown(legend_html, unsafe_allow_html=True)
 
-    # 4.4.2. Tab 2: 성연령별 분석
+    # 4.3.2. Tab 2: 성연령별 분석
     with tab2:
         st.subheader('성연령별 분석')
         target_ids = final_df['ftr_idn'].unique()
         
         if demographics is not None and not demographics.empty:
-            demo_mask = (demographics['month'] == selected_month) & (demographics['ftr_idn'].isin(final_selected_idns))
+            target_demo = demographics.loc[demographics.index.intersection(final_selected_idns)]
 
             if selected_gender != '전체':
-                demo_mask &= (demographics['gender'] == selected_gender)
+                target_demo = target_demo[target_demo['gender'] == selected_gender]
             if selected_age_code != 0:
-                demo_mask &= (demographics['age'] == selected_age_code)
-
-            target_demo = demographics[demo_mask].copy()
+                target_demo = target_demo[target_demo['age'] == selected_age_code]
             
             if not target_demo.empty:
                 # final_df 기준 Ratio 매핑
                 final_df['calc_ratio'] = np.where(final_df['reach'] > 0, final_df['adj_reach'] / final_df['reach'], 1.0)
-                ratio_map = final_df[['ftr_idn', 'calc_ratio']].set_index('ftr_idn')
-                
-                target_demo = target_demo.join(ratio_map, on='ftr_idn')
-                target_demo['calc_ratio'] = target_demo['calc_ratio'].fillna(1.0)
+                ratio_series = pd.Series(final_df['calc_ratio'].to_numpy(), index=final_df['ftr_idn'].to_numpy())
                 
-                target_demo['adj_demo_rots'] = target_demo['rots'] * target_demo['calc_ratio']
-                target_demo['adj_demo_reach'] = target_demo['reach'] * target_demo['calc_ratio']
+                calc_ratio = target_demo['ftr_idn'].map(ratio_series).fillna(1.0).to_numpy()
+                adj_demo = target_demo[['rots', 'reach']].to_numpy(dtype=float) * calc_ratio[:, None]
+                target_demo = target_demo.assign(
+                    calc_ratio=calc_ratio,
+                    adj_demo_rots=adj_demo[:, 0],
+                    adj_demo_reach=adj_demo[:, 1]
+                )
                 
-                gender_summ = target_demo.groupby('gender')[['adj_demo_rots', 'adj_demo_reach']].sum().reset_index()
+                gender_summ = target_demo.groupby('gender', observed=True)[['adj_demo_rots', 'adj_demo_reach']].sum().reset_index()
                 age_summ = target_demo.groupby('age')[['adj_demo_rots', 'adj_demo_reach']].sum().reset_index()
                 
                 # 가중치 적용
@@ -698,14 +957,15 @@ if kpi is not None and len(final_selected_idns) > 0:
                     st.plotly_chart(fig_age, use_container_width=True)
                 
                 with st.expander('성연령별 상세 데이터 보기'):
-                    pivot_demo = target_demo.groupby(['age', 'gender'])[['adj_demo_rots', 'adj_demo_reach']].sum().reset_index()
+                    pivot_demo = target_demo.groupby(['age', 'gender'], observed=True)[['adj_demo_rots', 'adj_demo_reach']].sum().reset_index()
                     pivot_demo['adj_demo_reach'] = pivot_demo['adj_demo_reach'] * cur_correction
 
                     pivot_demo['age'] = pivot_demo['age'].map(age_map_disp)
                     pivot_demo['gender'] = pivot_demo['gender'].map(gender_map_disp)
                     
                     pivot_demo = pivot_demo.rename(columns={'age':'연령', 'gender':'성별', 'adj_demo_rots':'ROTS', 'adj_demo_reach':'Reach'})
-                    st.dataframe(pivot_demo.style.format({'ROTS': '{:,.0f}', 'Reach': '{:,.0f}'}), use_container_width=True)
+                    pivot_demo[['ROTS', 'Reach']] = pivot_demo[['ROTS', 'Reach']].round()
+                    st.dataframe(pivot_demo, column_config=METRIC_COLUMN_CONFIG, use_container_width=True)
             else:
                 st.info('선택된 매체에 해당하는 성연령 데이터가 없습니다.')
         else: